@@ -10,12 +10,17 @@ Python conversion by Martin Craig 2021, Nottingham
 
 (c) 2021 University of Nottingham
 """
+import hashlib
+import os
+import zipfile
+
 try:
     import tensorflow.compat.v1 as tf
 except ImportError:
     import tensorflow as tf
 
 import numpy as np
+from scipy.signal import find_peaks
 #import tensorflow_probability as tfp
 
 from vaby.model import Model, ModelOption
@@ -58,17 +63,45 @@ class CvrPetCo2Model(Model):
         Model.__init__(self, data_model, **options)
 
         if isinstance(self.phys_data, str):
-            self.phys_data = np.loadtxt(self.phys_data)
-        self._preproc_co2()
+            self._preproc_co2_cached(self.phys_data)
+        else:
+            self._preproc_co2()
+
+        # PETCO2 interpolation tables as graph constants so evaluation does
+        # not re-upload them from host memory on every call. Value and diff
+        # are fused into a single [N, 2] table so delayed interpolation can
+        # fetch both with one gather and the pairs share a cache line
+        self._co2_const = tf.constant(self.co2_mmHg, dtype=tf.float32)
+        self._co2_table = tf.constant(np.stack([self.co2_mmHg, self.co2_diff], axis=1), dtype=tf.float32)
+        self._co2_idx_max = tf.constant(len(self.co2_mmHg)-1, dtype=tf.float32)
 
         self.params = [
             get_parameter("cvr", mean=1.0, dist="FoldedNormal", prior_var=2000, post_var=10, **options),
         ]
+        # Index of each parameter in the params list, resolved here so the
+        # traced evaluation can use static indices rather than a runtime counter
+        self._param_idx = {"cvr" : 0}
         if self.infer_sig0:
+            self._param_idx["sig0"] = len(self.params)
             self.params.append(get_parameter("sig0", mean=1, prior_var=1e9, post_mean=1, post_var=10, post_init=self._init_sig0, **options))
         if self.infer_delay:
+            self._param_idx["delay"] = len(self.params)
             self.params.append(get_parameter("delay", mean=0, prior_var=2500, post_var=10, **options))
 
+        # Stage the model evaluation as a graph so TF can fuse ops rather than
+        # retracing them eagerly on every VB iteration. Fixing the input
+        # signature avoids a retrace when the node/sample batch shape changes,
+        # and XLA compilation fuses the elementwise signal model into a
+        # single kernel rather than one launch (and temporary) per op
+        self._evaluate_graph = tf.function(
+            self._evaluate_impl,
+            input_signature=[
+                [tf.TensorSpec([None, None, 1], tf.float32)] * len(self.params),
+                tf.TensorSpec([None, None, None], tf.float32),
+            ],
+            jit_compile=True,
+        )
+
     def _init_sig0(self, _param, _t, data):
         return np.mean(data, axis=-1), None
 
@@ -121,50 +154,69 @@ class CvrPetCo2Model(Model):
         :return: [W, S, N] tensor containing model output at the specified time values
                  and for each time value using the specified parameter values
         """
-        cvr = params[0]
+        params = [tf.convert_to_tensor(params[idx], dtype=tf.float32) for idx in range(len(self.params))]
+        tpts = tf.convert_to_tensor(tpts, dtype=tf.float32)
+
+        # Normalise to the [W, S, 1] / [W, 1, N] ranks the graph was traced
+        # with - AVB evaluates with [W, 1] parameters and [1, N] timepoints
+        # with no sample dimension, in which case the output should not have
+        # one either
+        if tpts.shape.ndims == 2:
+            tpts = tf.expand_dims(tpts, 1)
+        squeeze_samples = params[0].shape.ndims == 2
+        if squeeze_samples:
+            params = [tf.expand_dims(p, 1) for p in params]
+
+        fit = self._evaluate_graph(params, tpts)
+        if squeeze_samples:
+            fit = tf.squeeze(fit, 1)
+        return fit
+
+    def _evaluate_impl(self, params, tpts):
+        """
+        Model evaluation - see :meth:`evaluate`. Traced by ``tf.function``
+        so must only use TF ops on its tensor arguments
+        """
+        cvr = params[self._param_idx["cvr"]]
 
-        extra_param = 1
         if self.infer_sig0:
-            sig0 = params[extra_param]
-            extra_param += 1
+            sig0 = params[self._param_idx["sig0"]]
         else:
             sig0 = 0
 
         if self.infer_delay:
-            delay = params[extra_param]
-            extra_param += 1
+            delay = params[self._param_idx["delay"]]
 
             # Apply time delay [W, (S), N]
             t_delayed = (tpts - delay) / self.tr
-            t_delayed = tf.clip_by_value(t_delayed, 0, len(self.co2_mmHg)-1)
-            t_base = tf.floor(t_delayed)
-
-            # Integer index into the CO2 and diff arrays
-            t_base_idx = tf.cast(t_base, tf.int32)
+            t_delayed = tf.clip_by_value(t_delayed, 0., self._co2_idx_max)
 
-            # Fractional distance to next array index, or 0 if base index was < 0
-            t_frac = tf.clip_by_value(t_delayed - t_base, 0, 1)
+            # Integer index into the CO2 table - since the clipped value is
+            # non-negative the int cast truncates exactly as floor would
+            t_base_idx = tf.cast(t_delayed, tf.int32)
 
-            # Tile PETCO2 arrays over all nodes so we can use tf.gather
-            co2_mmHg = tf.tile(self.co2_mmHg[np.newaxis, ...], (tf.shape(t_base_idx)[0], 1))
-            co2_diff = tf.tile(self.co2_diff[np.newaxis, ...], (tf.shape(t_base_idx)[0], 1))
+            # Fractional distance to next array index
+            t_frac = t_delayed - tf.cast(t_base_idx, tf.float32)
 
-            # Grab base and apply linear interpolation
-            delayed_co2_base = tf.gather(co2_mmHg, t_base_idx, axis=1, batch_dims=1)
-            delayed_co2_diff = tf.gather(co2_diff, t_base_idx, axis=1, batch_dims=1)
-            delayed_co2 = delayed_co2_base + t_frac * delayed_co2_diff
-            #delayed_co2 =  tfp.math.batch_interp_regular_1d_grid(t_delayed, 0, len(self.co2_mmHg), self.co2_mmHg, axis=-1)
+            # Grab base and diff values with a single gather from the fused
+            # table and apply linear interpolation. Gathering from the table
+            # preserves the index shape so there is no need to tile it over
+            # all nodes
+            co2_pair = tf.gather(self._co2_table, t_base_idx)
+            delayed_co2 = co2_pair[..., 0] + t_frac * co2_pair[..., 1]
         else:
             # No delay but still need to use tf.gather because we might only have
-            # a sample of the time points in SVB
-            t_base_idx = tf.cast(tf.floor(tpts / self.tr), tf.int32)
-            co2_mmHg = tf.tile(self.co2_mmHg[np.newaxis, ...], (tf.shape(t_base_idx)[0], 1))
-            delayed_co2 = tf.gather(co2_mmHg, t_base_idx, axis=1, batch_dims=1)
+            # a sample of the time points in SVB. Timepoints are non-negative so
+            # the int cast truncates exactly as floor would. The explicit clip
+            # matters under XLA, where out-of-range gather indices are silently
+            # clamped rather than raising as the eager CPU kernel does
+            t_base_idx = tf.cast(tf.clip_by_value(tpts / self.tr, 0., self._co2_idx_max), tf.int32)
+            delayed_co2 = tf.gather(self._co2_const, t_base_idx)
 
         # Sigmoid response
         #return sig0 + (b/(1+c.(e^(-(delayed_co2-c)/d))))/100
 
-        fit = sig0 * (1 + cvr * (delayed_co2 - self.min_co2mmHg) / 100)
+        fit = sig0 * (1 + cvr * (delayed_co2 - self.min_co2mmHg) * 0.01)
         return fit
 
     def tpts(self):
@@ -207,6 +259,69 @@ class CvrPetCo2Model(Model):
         lag = corr.argmax() - (len(y1) - 1)
         return np.max(corr), lag
 
+    def _preproc_co2_cached(self, fname):
+        """
+        Preprocess CO2 measurements from a physiological data file, caching
+        the result on disk
+
+        Parsing and preprocessing a dense recording can take several seconds
+        so the derived CO2 timecourse is cached keyed on a hash of the file
+        contents and the preprocessing options. Repeat runs on the same data,
+        e.g. when sweeping model options, skip the text parse and
+        preprocessing entirely.
+        """
+        with open(fname, "rb") as f:
+            data_hash = hashlib.md5(f.read()).hexdigest()
+        if self.data_start_time is None:
+            # The start time will be estimated by cross-correlation with the
+            # BOLD data, so the cached result depends on that data too
+            data_hash += "_" + hashlib.md5(self.data_model.data_flattened.tobytes()).hexdigest()
+        opts_key = "%s_%s_%s_%s_%s_%s" % (self.baseline, self.samp_rate, self.tr,
+                                          self.air_pressure, self.data_start_time,
+                                          self.data_model.n_tpts)
+        cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "vaby_cvr")
+        cache_fname = os.path.join(cache_dir, "%s_%s.npz" % (data_hash, opts_key))
+        if os.path.exists(cache_fname):
+            # A corrupt or stale cache file must not stop the model being
+            # built - fall back to preprocessing from scratch, which also
+            # rewrites the bad file
+            try:
+                cache = np.load(cache_fname)
+                self.petco2 = cache["petco2"]
+                self.co2_mmHg = cache["co2_mmHg"]
+                self.data_start_time = float(cache["data_start_time"])
+                self._postproc_co2()
+                self.log.info("Using cached PETCO2 preprocessing from %s", cache_fname)
+                return
+            except (OSError, KeyError, ValueError, zipfile.BadZipFile) as exc:
+                self.log.warning("Ignoring unreadable PETCO2 preprocessing cache %s: %s", cache_fname, exc)
+
+        self.phys_data = np.loadtxt(fname)
+        self._preproc_co2()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write via a temporary file and rename so an interrupted run
+            # cannot leave a truncated cache file behind
+            temp_fname = cache_fname + ".tmp"
+            with open(temp_fname, "wb") as f:
+                np.savez(f, petco2=self.petco2, co2_mmHg=self.co2_mmHg,
+                         data_start_time=self.data_start_time)
+            os.replace(temp_fname, cache_fname)
+        except OSError as exc:
+            self.log.warning("Could not write PETCO2 preprocessing cache: %s", exc)
+
+    def _postproc_co2(self):
+        """
+        Derive interpolation and normalisation quantities from the CO2 timecourse
+        """
+        # Differences between timepoints for quick interpolation. Given a delay
+        # time > 0 we can compute co2 = co2[int(delay)] + frac(delay) * diff[int(delay)]
+        self.co2_diff = np.append(np.diff(self.co2_mmHg), 0).astype(np.float32, copy=False)
+
+        # norm/hypercap measures
+        self.min_co2mmHg = np.min(self.co2_mmHg)
+        self.max_co2mmHg = np.max(self.co2_mmHg)
+
     def _preproc_co2(self):
         """
         Preprocess CO2 measurements from physiological data file
@@ -229,68 +344,43 @@ class CvrPetCo2Model(Model):
         self.log.debug("data start: %f", self.data_start_time)
         petco2_trim = self.petco2[int(self.data_start_time * self.samp_rate):]
 
-        # Determined respiratory frequency during baseline and use info to
-        # determine size of end-tidal search window
-        baseline_vols = int(self.baseline * self.samp_rate)
-        baseline_fft = np.fft.fft(petco2_trim[:baseline_vols])
-        p2 = np.abs(baseline_fft/baseline_vols)
-        p1 = np.array(p2[:int(baseline_vols/2)+1])
-        p1[1:-2] = 2*p1[1:-2]
-        f = np.linspace(0, self.samp_rate/2, int(baseline_vols/2)+1)
-
-        loc = np.argmax(p1[1:])
-
-        pkloc = loc+1
-        harm = f[pkloc]
-        resp_period = round(1/harm) # e.g. 8s
+        # Determine respiratory period during baseline from the median
+        # spacing of breath peaks and use info to determine size of end-tidal
+        # search window. The minimum peak separation of 0.25s and the
+        # prominence threshold restrict the count to breath-scale peaks so
+        # within-breath noise does not drag the period estimate down
+        baseline = petco2_trim[:int(self.baseline * self.samp_rate)]
+        prominence = 0.1 * (np.max(baseline) - np.min(baseline))
+        peaks, _ = find_peaks(baseline, distance=self.samp_rate//4, prominence=prominence)
+        if len(peaks) < 2:
+            raise ValueError("Could not identify at least two PETCO2 peaks in the baseline block - "
+                             "check the baseline length, sampling rate and data start time")
+        resp_period = int(round(np.median(np.diff(peaks)) / self.samp_rate)) # e.g. 8s
 
         # Search window = 1 second more than the respiratory period
         nsearch_vols = int((resp_period+1)*self.samp_rate)
         windows = int(np.floor(petco2_trim.shape[0]/nsearch_vols))
 
         # Find peak PETCO2 in each window - it's value and index position
-        posmax = np.zeros(windows, dtype=np.int)
-        winmax = np.zeros(windows)
-        for i in range(windows):
-            for j in range(nsearch_vols):
-                if j == 0 or petco2_trim[i*nsearch_vols+j] > winmax[i]:
-                    winmax[i] = petco2_trim[i*nsearch_vols+j]
-                    posmax[i] = i*nsearch_vols+j
-
-        # Make new full sample ET time course where the PETCO2 changes linearly
-        # between window maxima
-        self.petco2_resamp = np.zeros((petco2_trim.shape[0], 1))
-        for x in range(windows-1):
-            dist_c = posmax[x+1] - posmax[x]
-            step_c = winmax[x+1] - winmax[x]
-            ramp_c = step_c / dist_c
-            for g in range(dist_c+1):
-                self.petco2_resamp[posmax[x]+g] = winmax[x] + (ramp_c * g)
-
-        # Pad the start and end with repeats of first and last value to maintain
-        # length and phase
-        self.petco2_resamp[:posmax[0]] = self.petco2_resamp[posmax[0]]
-        self.petco2_resamp[posmax[-1]:] = self.petco2_resamp[posmax[-1]]
-
-        # Create a timecourse of the end tidal CO2 values at the TR's for use with CVR sigmoids
-        # Make new time course at the TR resolution and normalise timecourse betwwen 0 and 1 to create EV
+        trim = petco2_trim[:windows*nsearch_vols].reshape(windows, nsearch_vols)
+        posmax_in_win = trim.argmax(axis=1)
+        winmax = trim[np.arange(windows), posmax_in_win]
+        posmax = (posmax_in_win + np.arange(windows)*nsearch_vols).astype(np.int32)
+
+        # Create a timecourse of the end tidal CO2 values at the TR's for use with CVR sigmoids,
+        # where the PETCO2 changes linearly between window maxima. The piecewise-linear
+        # function is evaluated directly at the last raw sample of each TR block, avoiding
+        # a full-rate intermediate timecourse. np.interp clamps to the first/last peak
+        # value outside the peak range so length and phase are maintained
         block = int(round(self.tr*self.samp_rate))
-        ev_co2 = np.zeros((self.data_model.n_tpts,), dtype=np.float32)
-        for i in range(self.data_model.n_tpts):
-            ev_co2[i] = self.petco2_resamp[block * i + block-1]
+        tr_grid = np.arange(self.data_model.n_tpts) * block + (block-1)
+        ev_co2 = np.interp(tr_grid, posmax, winmax).astype(np.float32)
 
         # Convert to mmHg
         air_pressure_mmhg = self.air_pressure/1.33322387415 # pressure mbar
         self.co2_mmHg = (ev_co2 * air_pressure_mmhg) / 100 # div by 100 as values are in percent
 
-        # Differences between timepoints for quick interpolation. Given a delay
-        # time > 0 we can compute co2 = co2[int(delay)] + frac(delay) * diff[int(delay)]
-        self.co2_diff = np.zeros(len(self.co2_mmHg), dtype=np.float32)
-        self.co2_diff[:-1] = self.co2_mmHg[1:] - self.co2_mmHg[:-1]
-
-        # norm/hypercap measures
-        self.min_co2mmHg = np.min(self.co2_mmHg)
-        self.max_co2mmHg = np.max(self.co2_mmHg)
+        self._postproc_co2()
 
         # Calculation of normo/hypercapnea from on/off volumes
         # Convert time periods to number of volumes